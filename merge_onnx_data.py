@@ -16,11 +16,92 @@ import os
 
 try:
     import onnx
+    from onnx.external_data_helper import ExternalDataInfo, load_external_data_for_model, uses_external_data
 except ImportError:
     print("Error: 'onnx' package not found.")
     print("Install it with: pip install onnx")
     sys.exit(1)
 
+# Field numbers from onnx.proto; repeated fields may appear in any order on the wire
+MODEL_GRAPH, GRAPH_INITIALIZER, TENSOR_RAW_DATA = 7, 5, 9
+
+
+def _varint(n):
+    out = bytearray()
+    while n > 0x7F:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _key(field, length):
+    """Protobuf tag + length prefix of a length-delimited field."""
+    return _varint(field << 3 | 2) + _varint(length)
+
+
+def _external_span(tensor, base_dir):
+    """(path, offset, length) of the bytes an external tensor points at."""
+    info = ExternalDataInfo(tensor)
+    path = os.path.join(base_dir, info.location)
+    offset = info.offset or 0
+    length = info.length if info.length is not None else os.path.getsize(path) - offset
+    return path, offset, length
+
+
+def _copy_span(out, path, offset, length, chunk=1 << 24):
+    with open(path, 'rb') as src:
+        src.seek(offset)
+        while length:
+            buf = src.read(min(chunk, length))
+            if not buf:
+                raise ValueError(f"External data file {path} is shorter than its tensors claim")
+            out.write(buf)
+            length -= len(buf)
+
+
+def save_streaming(model, output_path, base_dir):
+    """Write model with every external initializer inlined, copying tensor bytes in chunks.
+
+    onnx.save_model needs every tensor in memory at once. Here each initializer is written as
+    its serialized header followed by a raw_data field copied straight from the data file, so
+    only the graph structure is resident. The graph's length prefix is known up front from the
+    external-data lengths; initializers go after the other graph fields.
+    """
+    graph = onnx.GraphProto()
+    graph.CopyFrom(model.graph)
+    inits = list(graph.initializer)
+    del graph.initializer[:]
+    model.ClearField('graph')
+    # Tensors outside the initializer list (e.g. Constant attributes) are small; inline directly
+    shell = onnx.ModelProto(graph=graph)
+    load_external_data_for_model(shell, base_dir)
+    graph_bytes = shell.graph.SerializeToString()
+
+    parts = []
+    for tensor in inits:
+        span = None
+        if uses_external_data(tensor):
+            span = _external_span(tensor, base_dir)
+            tensor.data_location = onnx.TensorProto.DEFAULT
+            del tensor.external_data[:]
+        head = tensor.SerializeToString()
+        if span:
+            head += _key(TENSOR_RAW_DATA, span[2])
+        parts.append((head, span, len(head) + (span[2] if span else 0)))
+    graph_len = len(graph_bytes) + sum(len(_key(GRAPH_INITIALIZER, n)) + n for _, _, n in parts)
+
+    with open(output_path, 'wb') as f:
+        f.write(model.SerializeToString())
+        f.write(_key(MODEL_GRAPH, graph_len))
+        f.write(graph_bytes)
+        for head, span, size in parts:
+            f.write(_key(GRAPH_INITIALIZER, size))
+            f.write(head)
+            if span:
+                _copy_span(f, *span)
+
+
 def merge_external_data(model_path, output_path):
     """Load ONNX model and merge external data into it."""
     if not os.path.exists(model_path):
@@ -28,7 +109,8 @@ def merge_external_data(model_path, output_path):
         sys.exit(1)
     
     print(f"Loading model from {model_path}...")
-    model = onnx.load(model_path)
+    # Load the graph only; external tensor bytes are copied in while saving
+    model = onnx.load(model_path, load_external_data=False)
     
     # Check if external data file exists
     data_path = model_path + '.data'
@@ -39,7 +121,7 @@ def merge_external_data(model_path, output_path):
         print("No external data file found, model may already be self-contained.")
     
     # Save without external data (this merges it into the model)
-    onnx.save_model(model, output_path, save_as_external_data=False)
+    save_streaming(model, output_path, os.path.dirname(model_path))
     
     # Get file sizes for comparison
     input_size = os.path.getsize(model_path)
@@ -1,14 +1,28 @@
 """Dataset: render characters as they appear in terminal cells (8×16, natural positioning)."""
 
-import random
+import os
 import numpy as np
-from PIL import Image, ImageDraw, ImageFont
+from numba import njit
+from PIL import ImageFont
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset, get_worker_info
 from charset import get_charset
+from glyph_render import CELL_H, CELL_W, baseline_y_offset, render_glyph
 
-# Terminal cell aspect ratio 1:2
-CELL_W, CELL_H = 8, 16
+# Shared N(0, 1) pool; each augmented cell reads a random contiguous window from it
+# instead of drawing fresh Gaussians. Read-only, so forked workers share it copy-on-write.
+NOISE_POOL = np.random.default_rng(0).standard_normal(1 << 20, dtype=np.float32)
+
+
+@njit(cache=True, fastmath=True)
+def augment_inplace(arr, bg, fg, noise_sigma, noise, offset):
+    """Map 0 -> bg, 1 -> fg, add noise_sigma * noise[offset:], clip to [0, 1]. Operates on a float32 cell."""
+    scale = fg - bg
+    h, w = arr.shape
+    for y in range(h):
+        for x in range(w):
+            v = bg + arr[y, x] * scale + noise_sigma * noise[offset + y * w + x]
+            arr[y, x] = min(1.0, max(0.0, v))
 
 
 class CharacterDataset(Dataset):
@@ -16,61 +30,83 @@ class CharacterDataset(Dataset):
         self.chars = get_charset(charset)
         self.font_path = font_path
         self.samples_per_char = samples_per_char
-        # Font size chosen so typical chars fill the cell naturally
-        self.font = ImageFont.truetype(font_path, 14)  # ~14px for 16px cell height
+        self._open_font()
+        # Per-instance PCG64 stream (reseeded per worker)
+        self.rng = np.random.default_rng()
+        # Charset is fixed, so rasterize every glyph once: (num_chars, CELL_H, CELL_W) uint8
+        self.canonical = np.stack([self._raw_render(c) for c in self.chars])
         
+    def _open_font(self):
+        # Font size chosen so typical chars fill the cell naturally
+        self.font = ImageFont.truetype(self.font_path, 14)  # ~14px for 16px cell height
+        # Baseline at ~75% down the cell, ~12px from top (typical for 16px cell)
+        self._y = baseline_y_offset(self.font)
+
+    def __getstate__(self):
+        # FreeType handles don't pickle cheaply; workers reopen the font in worker_init_fn
+        state = self.__dict__.copy()
+        state.pop('font', None)
+        return state
+
     def __len__(self):
         return len(self.chars) * self.samples_per_char
 
     def __getitem__(self, idx):
         char_idx = idx % len(self.chars)
-        anchor = self._render(self.chars[char_idx], augment=True)
-        positive = self._render(self.chars[char_idx], augment=True)
+        anchor = self._cell(self.canonical[char_idx], augment=True)
+        positive = self._cell(self.canonical[char_idx], augment=True)
         return anchor, positive, char_idx
 
-    def _render(self, char: str, augment: bool = False) -> torch.Tensor:
+    def _raw_render(self, char: str) -> np.ndarray:
         """Render char in 8×16 cell at natural terminal position (baseline-aligned)."""
-        # Create cell-sized image
-        img = Image.new('L', (CELL_W, CELL_H), 0)
-        draw = ImageDraw.Draw(img)
-        
-        # Get font metrics for proper baseline positioning
-        # Draw at x=0, y positioned so baseline is ~12px from top (typical for 16px cell)
-        ascent, descent = self.font.getmetrics()
-        # Position: baseline at ~75% down the cell
-        baseline_y = int(CELL_H * 0.75)
-        y = baseline_y - ascent
-        
-        # Center horizontally in cell
-        bbox = draw.textbbox((0, 0), char, font=self.font)
-        char_w = bbox[2] - bbox[0]
-        x = (CELL_W - char_w) // 2 - bbox[0]
-        
-        draw.text((x, y), char, font=self.font, fill=255)
+        return render_glyph(char, self.font, self._y)
+
+    def _render(self, char: str, augment: bool = False) -> torch.Tensor:
+        return self._cell(self._raw_render(char), augment)
+
+    def _cell(self, glyph: np.ndarray, augment: bool = False) -> torch.Tensor:
+        """uint8 glyph -> (1, CELL_H, CELL_W) float tensor in [0, 1], optionally augmented."""
+        # The only allocation per sample: the array the returned tensor wraps
+        arr = np.divide(glyph, 255.0, dtype=np.float32)
         
         if augment:
-            img = self._augment(img)
+            self._augment(arr)
         
-        arr = np.array(img, dtype=np.float32) / 255.0
         return torch.from_numpy(arr).unsqueeze(0)
 
-    def _augment(self, img: Image.Image) -> Image.Image:
-        arr = np.array(img, dtype=np.float32)
-        
+    def _augment(self, arr: np.ndarray) -> None:
+        """Augment a [0, 1] float32 cell in place."""
         # Foreground/background color variation
         # Map 0 -> random(0-64), 255 -> random(192-255)
-        bg = random.randint(0, 64)
-        fg = random.randint(192, 255)
-        arr = bg + (arr / 255.0) * (fg - bg)
+        bg = self.rng.integers(0, 65) / 255.0
+        fg = self.rng.integers(192, 256) / 255.0
         
-        # Noise σ=8
-        if random.random() > 0.3:
-            arr = arr + np.random.normal(0, 8, arr.shape)
+        # Noise σ=8 (in 0-255 units), read from a random window of NOISE_POOL
+        noise_sigma = 8.0 / 255.0 if self.rng.random() > 0.3 else 0.0
+        offset = self.rng.integers(0, NOISE_POOL.size - CELL_H * CELL_W + 1)
         
-        return Image.fromarray(np.clip(arr, 0, 255).astype(np.uint8))
+        augment_inplace(arr, bg, fg, noise_sigma, NOISE_POOL, offset)
 
     def render_canonical(self, char_idx: int) -> torch.Tensor:
-        return self._render(self.chars[char_idx], augment=False)
+        return self._cell(self.canonical[char_idx], augment=False)
+
+
+def worker_init_fn(worker_id: int):
+    info = get_worker_info()
+    dataset = info.dataset
+    # info.seed is base_seed + worker_id, so workers draw independent augmentations
+    dataset.rng = np.random.default_rng(info.seed)
+    if not hasattr(dataset, 'font'):
+        dataset._open_font()
+
+
+def make_loader(dataset: CharacterDataset, batch_size: int) -> DataLoader:
+    """Shuffled multi-worker loader; persistent workers keep their font open across epochs."""
+    return DataLoader(dataset, batch_size=batch_size, shuffle=True,
+                      num_workers=max(1, (os.cpu_count() or 2) // 2),
+                      persistent_workers=True, prefetch_factor=4,
+                      pin_memory=torch.cuda.is_available(),
+                      worker_init_fn=worker_init_fn)
 
 
 if __name__ == '__main__':
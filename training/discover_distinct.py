@@ -3,97 +3,52 @@
 
 import numpy as np
 import torch
-from PIL import Image, ImageDraw, ImageFont
-from fontTools.ttLib import TTFont
-from model import CharEncoder
+from PIL import ImageFont
+from glyph_render import EMOJI_RANGES, font_codepoints, render_chars
+from model import CharEncoder, embed
 
-CELL_W, CELL_H = 8, 16
 
-# Emoji ranges to exclude
-EMOJI_RANGES = [
-    (0x1F300, 0x1F9FF),
-    (0x2600, 0x26FF),
-    (0x2700, 0x27BF),
-    (0xFE00, 0xFE0F),
-    (0x1F000, 0x1FFFF),
-]
-
-
-def is_emoji(cp: int) -> bool:
-    for start, end in EMOJI_RANGES:
-        if start <= cp <= end:
-            return True
-    return False
+# BMP lookup table: True where the codepoint falls in an emoji range
+_EMOJI_BMP = np.zeros(0x10000, dtype=np.bool_)
+for _start, _end in EMOJI_RANGES:
+    _EMOJI_BMP[_start:_end + 1] = True
 
 
 def get_font_chars(font_path: str) -> list[str]:
     """Get all non-emoji chars from font."""
-    tt = TTFont(font_path)
-    chars = []
-    for table in tt['cmap'].tables:
-        if hasattr(table, 'cmap'):
-            for cp in table.cmap.keys():
-                if cp < 0x20 or cp > 0xFFFF or is_emoji(cp):
-                    continue
-                char = chr(cp)
-                if char not in chars:
-                    chars.append(char)
-    tt.close()
-    return sorted(chars, key=ord)
-
-
-def render_char(char: str, font: ImageFont.FreeTypeFont) -> np.ndarray:
-    """Render char to 8×16 with natural baseline positioning."""
-    img = Image.new('L', (CELL_W, CELL_H), 0)
-    draw = ImageDraw.Draw(img)
-    
-    ascent, descent = font.getmetrics()
-    baseline_y = int(CELL_H * 0.75)
-    y = baseline_y - ascent
-    
-    bbox = draw.textbbox((0, 0), char, font=font)
-    char_w = bbox[2] - bbox[0]
-    x = (CELL_W - char_w) // 2 - bbox[0]
-    
-    draw.text((x, y), char, font=font, fill=255)
-    return np.array(img, dtype=np.float32) / 255.0
-
-
+    cps = font_codepoints(font_path)
+    return [chr(cp) for cp in cps[~_EMOJI_BMP[cps]].tolist()]
 
 
-def compute_embeddings(chars: list[str], font: ImageFont.FreeTypeFont, encoder: CharEncoder) -> np.ndarray:
-    """Compute embeddings for all chars."""
-    encoder.eval()
-    embeddings = []
-    with torch.no_grad():
-        for char in chars:
-            img = render_char(char, font)
-            tensor = torch.from_numpy(img).unsqueeze(0).unsqueeze(0)
-            emb = encoder(tensor).squeeze().numpy()
-            embeddings.append(emb)
-    return np.array(embeddings)
+def compute_embeddings(chars: list[str], font: ImageFont.FreeTypeFont, encoder: CharEncoder,
+                       compile: bool = False) -> np.ndarray:
+    """Compute embeddings for all chars in batched forward passes."""
+    return embed(encoder, render_chars(chars, font)[:, None], compile=compile)
 
 
 def select_distinct(chars: list[str], embeddings: np.ndarray, threshold: float = 0.85) -> list[str]:
     """Greedily select chars with pairwise similarity below threshold."""
     n = len(chars)
-    # Compute similarity matrix (cosine sim, embeddings already normalized)
-    sim = embeddings @ embeddings.T
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    # Running max cosine sim of every char to the selected set (embeddings already normalized),
+    # updated with one GEMV per admitted char instead of materializing the N×N matrix
+    max_sim = np.full(n, -np.inf, dtype=np.float32)
+    below = np.empty(n, dtype=bool)
     
     selected = []
-    selected_idx = []
     
-    for i in range(n):
-        # Check if this char is distinct from all selected
-        if not selected_idx:
-            selected.append(chars[i])
-            selected_idx.append(i)
-            continue
+    i = 0
+    while i < n:
+        # chars[i] is distinct from all selected
+        selected.append(chars[i])
+        np.maximum(max_sim, embeddings @ embeddings[i], out=max_sim)
         
-        max_sim = sim[i, selected_idx].max()
-        if max_sim < threshold:
-            selected.append(chars[i])
-            selected_idx.append(i)
+        # Jump straight to the next char still below threshold
+        rest = below[i + 1:]
+        np.less(max_sim[i + 1:], threshold, out=rest)
+        if not rest.any():
+            break
+        i += 1 + int(rest.argmax())
     
     return selected
 
@@ -105,6 +60,7 @@ def main():
     p.add_argument('--checkpoint', required=True)
     p.add_argument('--threshold', type=float, default=0.85, help='Max similarity (lower = more distinct)')
     p.add_argument('--output', default='discovered_charset.py')
+    p.add_argument('--compile', action='store_true', help='torch.compile the encoder (pays off for large fonts)')
     args = p.parse_args()
     
     print(f"Scanning font: {args.font}")
@@ -115,11 +71,11 @@ def main():
     
     print(f"Loading model: {args.checkpoint}")
     ckpt = torch.load(args.checkpoint, map_location='cpu', weights_only=False)
-    encoder = CharEncoder(ckpt['embedding_dim'])
+    encoder = CharEncoder(ckpt['embedding_dim'], ckpt.get('downsample', 'pool'))
     encoder.load_state_dict(ckpt['encoder'])
     
     print("Computing embeddings...")
-    embeddings = compute_embeddings(chars, font, encoder)
+    embeddings = compute_embeddings(chars, font, encoder, args.compile)
     
     print(f"Selecting distinct chars (threshold={args.threshold})...")
     distinct = select_distinct(chars, embeddings, args.threshold)
@@ -2,26 +2,27 @@
 """Export trained model to ONNX with embeddings for all monochrome Unicode."""
 
 import argparse
+import functools
 import json
 import numpy as np
+import os
+import struct
 import torch
 import unicodedata
 from pathlib import Path
-from PIL import Image, ImageDraw, ImageFont
-from fontTools.ttLib import TTFont
+from PIL import ImageFont
 
-from model import CharEncoder
+from glyph_render import CELL_H, CELL_W, EMOJI_RANGES, font_codepoints, render_chars
+from model import CharEncoder, embed, l2_normalize
 
-CELL_W, CELL_H = 8, 16
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None  # Fall back to PyTorch for the embedding sweep
 
 # Ranges to EXCLUDE (emoji + RTL scripts + complex scripts)
 EXCLUDE_RANGES = [
-    # Emoji
-    (0x1F300, 0x1F9FF),  # Miscellaneous Symbols and Pictographs, Emoticons, etc.
-    (0x2600, 0x26FF),    # Miscellaneous Symbols (many are emoji)
-    (0x2700, 0x27BF),    # Dingbats (many are emoji)
-    (0xFE00, 0xFE0F),    # Variation Selectors
-    (0x1F000, 0x1FFFF),  # All supplementary symbols
+    *EMOJI_RANGES,
     # RTL scripts (mess up text direction)
     (0x0590, 0x05FF),    # Hebrew
     (0x0600, 0x06FF),    # Arabic
@@ -65,94 +66,137 @@ ADDITIONAL_EXCLUDE_RANGES = [
 ]
 
 
-def is_excluded(cp: int) -> bool:
-    """Check if codepoint should be excluded."""
-    # Check explicit ranges (emoji, RTL, complex scripts)
-    for start, end in EXCLUDE_RANGES:
-        if start <= cp <= end:
-            return True
-    
-    # Check additional exclusion ranges (narrow/variable-width chars)
-    for start, end in ADDITIONAL_EXCLUDE_RANGES:
-        if start <= cp <= end:
-            return True
-    
-    # Check for problematic characters using Unicode category
-    try:
+def _build_exclusion_table() -> np.ndarray:
+    """Boolean mask over the BMP: True for codepoints in the exclusion ranges, in an
+    EXCLUDE_CATEGORIES category, or East Asian Wide/Fullwidth (these break monospace alignment)."""
+    excluded = np.zeros(0x10000, dtype=np.bool_)
+    for start, end in EXCLUDE_RANGES + ADDITIONAL_EXCLUDE_RANGES:
+        excluded[start:end + 1] = True
+    for cp in range(0x10000):
         char = chr(cp)
-        category = unicodedata.category(char)
-        if category in EXCLUDE_CATEGORIES:
-            return True
-        
-        # Also exclude characters with east asian width 'W' or 'F' (double-width)
-        # as they break monospace alignment
-        ea_width = unicodedata.east_asian_width(char)
-        if ea_width in ('W', 'F'):  # Wide or Fullwidth
-            return True
-            
-    except (ValueError, TypeError):
-        return True
-    
-    return False
+        if (unicodedata.category(char) in EXCLUDE_CATEGORIES
+                or unicodedata.east_asian_width(char) in ('W', 'F')):
+            excluded[cp] = True
+    return excluded
+
+
+_EXCLUDED_BMP = _build_exclusion_table()
 
 
 def get_font_chars(font_path: str) -> list[str]:
     """Get all characters available in the font, excluding emoji."""
-    tt = TTFont(font_path)
-    chars = []
-    
-    for table in tt['cmap'].tables:
-        if hasattr(table, 'cmap'):
-            for cp in table.cmap.keys():
-                if cp < 0x20:  # Skip control chars
-                    continue
-                if cp > 0xFFFF:  # Skip supplementary planes (mostly emoji)
-                    continue
-                if is_excluded(cp):
-                    continue
-                char = chr(cp)
-                if char not in chars:
-                    chars.append(char)
-    
-    tt.close()
-    return sorted(chars, key=ord)
+    cps = font_codepoints(font_path)
+    return [chr(cp) for cp in cps[~_EXCLUDED_BMP[cps]].tolist()]
 
 
-def render_char(char: str, font: ImageFont.FreeTypeFont) -> np.ndarray:
-    """Render char to 8×16 with natural baseline positioning."""
-    img = Image.new('L', (CELL_W, CELL_H), 0)
-    draw = ImageDraw.Draw(img)
-    
-    ascent, descent = font.getmetrics()
-    baseline_y = int(CELL_H * 0.75)
-    y = baseline_y - ascent
-    
-    bbox = draw.textbbox((0, 0), char, font=font)
-    char_w = bbox[2] - bbox[0]
-    x = (CELL_W - char_w) // 2 - bbox[0]
+# Headered embedding files: b'EMB1', uint32 rows, uint32 cols, numpy dtype str (8 bytes),
+# zero-padded so the row-major data starts 64-byte aligned for zero-copy TypedArray/SIMD views
+EMB_MAGIC = b'EMB1'
+EMB_HEADER_SIZE = 64
+
+
+def write_embeddings(path: Path, emb: np.ndarray):
+    """Write emb with an EMB1 header (see EMB_HEADER_SIZE) followed by contiguous row-major data."""
+    header = struct.pack('<4sII8s', EMB_MAGIC, *emb.shape, emb.dtype.str.encode())
+    with open(path, 'wb') as f:
+        f.write(header.ljust(EMB_HEADER_SIZE, b'\0'))
+        f.write(np.ascontiguousarray(emb).tobytes())
+
+
+def quantize_int8(emb: np.ndarray) -> tuple[np.ndarray, float]:
+    """Symmetric per-matrix int8 quantization of unit rows. Returns (int8 values, dequantization scale).
+
+    Unit rows keep every value in [-1, 1], so the scale is at most 1/127; scaling to the actual
+    max instead of a fixed 1/127 spends the whole int8 range on the values that occur.
+    """
+    if emb.size == 0:  # Font with no eligible chars
+        return emb.astype(np.int8), 1.0 / 127.0
+    scale = min(float(np.abs(emb).max()), 1.0) / 127.0 or 1.0 / 127.0
+    return np.clip(np.round(emb / scale), -127, 127).astype(np.int8), scale
+
+
+def _run_bound(sess, imgs: np.ndarray, batch_size: int, device: str) -> np.ndarray:
+    """Run sess over imgs through io_binding with one reused device input buffer.
+
+    Each chunk is staged into the same host array, so it costs one host->device copy and one
+    device->host copy of the outputs instead of per-run allocations on both sides.
+    """
+    staging = np.zeros((batch_size, 1, CELL_H, CELL_W), dtype=np.float32)
+    device_in = ort.OrtValue.ortvalue_from_numpy(staging, device, 0)
+    io = sess.io_binding()
+    io.bind_ortvalue_input('image', device_in)
+    io.bind_output('embedding', device)
+    chunks = []
+    for i in range(0, len(imgs), batch_size):
+        n = min(batch_size, len(imgs) - i)
+        staging[:n] = imgs[i:i + n]  # Rows past n are stale and sliced off below
+        device_in.update_inplace(staging)
+        sess.run_with_iobinding(io)
+        chunks.append(io.copy_outputs_to_cpu()[0][:n])
+    return np.concatenate(chunks)
+
+
+def embed_onnx(model_path: Path, imgs: np.ndarray, batch_size: int = 1024) -> np.ndarray:
+    """Embed (N, 1, 16, 8) images with ONNX Runtime using the exported graph (CUDA if available)."""
+    so = ort.SessionOptions()
+    so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    providers = ['CPUExecutionProvider']
+    if 'CUDAExecutionProvider' in ort.get_available_providers():
+        providers.insert(0, 'CUDAExecutionProvider')
+    sess = ort.InferenceSession(str(model_path), so, providers=providers)
     
-    draw.text((x, y), char, font=font, fill=255)
-    return np.array(img, dtype=np.float32) / 255.0
+    if len(imgs) == 0:
+        return np.empty((0, sess.get_outputs()[0].shape[1]), dtype=np.float32)
+    if sess.get_providers()[0] == 'CUDAExecutionProvider':
+        emb = _run_bound(sess, imgs, batch_size, 'cuda')
+    else:
+        emb = np.concatenate([sess.run(None, {'image': imgs[i:i + batch_size]})[0]
+                              for i in range(0, len(imgs), batch_size)])
+    return l2_normalize(emb)
 
 
-def export(args):
-    ckpt = torch.load(args.checkpoint, map_location='cpu', weights_only=False)
-    dim = ckpt['embedding_dim']
+def quantize_onnx(model_path: Path, output_path: Path, imgs: np.ndarray, batch_size: int = 256):
+    """Post-training static INT8 quantization (QDQ, per-channel), calibrated on rendered glyphs."""
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+    class GlyphReader(CalibrationDataReader):
+        def __init__(self):
+            self.batches = iter(imgs[i:i + batch_size] for i in range(0, len(imgs), batch_size))
+
+        def get_next(self):
+            batch = next(self.batches, None)
+            return None if batch is None else {'image': batch}
+
+    quantize_static(str(model_path), str(output_path), GlyphReader(),
+                    quant_format=QuantFormat.QDQ, per_channel=True, weight_type=QuantType.QInt8)
 
-    encoder = CharEncoder(dim)
+
+@functools.lru_cache(maxsize=4)
+def _load_encoder(path: str, mtime: float) -> tuple[CharEncoder, dict]:
+    """Load and fuse a checkpoint's encoder. Cached on (path, mtime) so repeated export()
+    calls in one process skip torch.load, but a rewritten checkpoint is reloaded."""
+    ckpt = torch.load(path, map_location='cpu', weights_only=False)
+    encoder = CharEncoder(ckpt['embedding_dim'], ckpt.get('downsample', 'pool'))
     encoder.load_state_dict(ckpt['encoder'])
-    encoder.eval()
+    encoder.fuse()  # Fold BatchNorm into the convs: fewer ops in the exported graph
+    return encoder, ckpt
+
+
+def export(args):
+    encoder, ckpt = _load_encoder(args.checkpoint, os.path.getmtime(args.checkpoint))
+    dim = ckpt['embedding_dim']
 
     out = Path(args.output)
 
     # ONNX export (without external data for web compatibility)
-    # Use opset 13 to avoid version conversion issues
+    # The dynamo exporter emits opset 18 natively; requesting anything older
+    # goes through the version converter, which fails on ReduceL2
     torch.onnx.export(encoder, torch.randn(1, 1, 16, 8), out.with_suffix('.onnx'),
                       input_names=['image'], output_names=['embedding'],
-                      dynamic_axes={'image': {0: 'batch'}, 'embedding': {0: 'batch'}}, 
-                      opset_version=13,  # Use 13 to avoid conversion issues
-                      export_params=True,  # Embed parameters in model
-                      do_constant_folding=True)  # Fold constants
+                      dynamic_shapes={'x': {0: torch.export.Dim('batch')}},
+                      opset_version=18,
+                      dynamo=True,
+                      external_data=False)  # Embed parameters in model
     print(f"Saved {out.with_suffix('.onnx')}")
 
     # Get all chars from font
@@ -160,36 +204,50 @@ def export(args):
     chars = get_font_chars(args.font)
     print(f"Found {len(chars)} characters in font")
     
-    # Render and compute embeddings + luminosities
+    # Render all chars first, then compute embeddings in one batched pass.
+    # chars come from the font's cmap, so every one is renderable: no per-char try/except
     font = ImageFont.truetype(args.font, 14)
-    emb = []
-    luminosities = []
-    valid_chars = []
+    imgs = render_chars(chars, font)[:, None]
+
+    # Average luminosity per char (0-1 range)
+    luminosities = imgs.mean(axis=(1, 2, 3)).tolist()
+
+    # ORT runs the exported graph several times faster than eager PyTorch on CPU
+    if ort is not None and not args.compile:
+        emb = embed_onnx(out.with_suffix('.onnx'), imgs, args.batch_size)
+    else:
+        emb = embed(encoder, imgs, args.batch_size, compile=args.compile)
     
-    with torch.no_grad():
-        for c in chars:
-            try:
-                img = render_char(c, font)
-                tensor = torch.from_numpy(img).unsqueeze(0).unsqueeze(0)
-                emb.append(encoder(tensor).squeeze().numpy())
-                # Compute average luminosity (0-1 range)
-                avg_lum = img.mean()
-                luminosities.append(float(avg_lum))
-                valid_chars.append(c)
-            except:
-                pass  # Skip chars that fail to render
+    if args.quantize:
+        quantize_onnx(out.with_suffix('.onnx'), out.with_suffix('.int8.onnx'), imgs)
+        print(f"Saved {out.with_suffix('.int8.onnx')}")
     
-    emb = np.array(emb, dtype=np.float32)
     emb.tofile(out.with_suffix('.embeddings.bin'))
     print(f"Saved {out.with_suffix('.embeddings.bin')} {emb.shape}")
 
+    # Compact copies for bandwidth-bound clients; the float32 .bin stays the reference
+    emb_q, q_scale = quantize_int8(emb)
+    write_embeddings(out.with_suffix('.embeddings.i8'), emb_q)
+    write_embeddings(out.with_suffix('.embeddings.f16'), emb.astype(np.float16))
+    print(f"Saved {out.with_suffix('.embeddings.i8')} and {out.with_suffix('.embeddings.f16')}")
+
     with open(out.with_suffix('.chars.json'), 'w') as f:
         json.dump({
-            'chars': valid_chars, 
+            'chars': chars, 
             'embedding_dim': dim,
-            'luminosities': luminosities  # Precomputed average luminosities (0-1)
+            'luminosities': luminosities,  # Precomputed average luminosities (0-1)
+            'normalized': True,  # Embedding rows are L2-normalized; dot product = cosine similarity
+            # The .bin is headerless little-endian float32 (num_chars, embedding_dim), as the
+            # Rust and web loaders expect. The quantized files carry an EMB1 header and their
+            # data starts at 'offset'; int8 dequantizes as value * scale
+            'quantized': {
+                'int8': {'file': out.with_suffix('.embeddings.i8').name, 'dtype': 'int8',
+                         'offset': EMB_HEADER_SIZE, 'scale': q_scale},
+                'float16': {'file': out.with_suffix('.embeddings.f16').name, 'dtype': 'float16',
+                            'offset': EMB_HEADER_SIZE},
+            },
         }, f)
-    print(f"Saved {out.with_suffix('.chars.json')} ({len(valid_chars)} chars with luminosities)")
+    print(f"Saved {out.with_suffix('.chars.json')} ({len(chars)} chars with luminosities)")
 
 
 if __name__ == '__main__':
@@ -197,4 +255,7 @@ if __name__ == '__main__':
     p.add_argument('--checkpoint', required=True)
     p.add_argument('--output', default='model')
     p.add_argument('--font', required=True)
+    p.add_argument('--batch-size', type=int, default=1024, help='Chars per encoder forward pass')
+    p.add_argument('--quantize', action='store_true', help='Also write an INT8 (QDQ) .int8.onnx model (needs onnxruntime)')
+    p.add_argument('--compile', action='store_true', help='torch.compile the encoder (pays off for large fonts)')
     export(p.parse_args())
@@ -0,0 +1,105 @@
+"""Shared glyph rasterization: render chars as they appear in 8×16 terminal cells."""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from fontTools.ttLib import TTFont
+
+# Terminal cell aspect ratio 1:2
+CELL_W, CELL_H = 8, 16
+
+# Emoji ranges to exclude
+EMOJI_RANGES = [
+    (0x1F300, 0x1F9FF),  # Miscellaneous Symbols and Pictographs, Emoticons, etc.
+    (0x2600, 0x26FF),    # Miscellaneous Symbols (many are emoji)
+    (0x2700, 0x27BF),    # Dingbats (many are emoji)
+    (0xFE00, 0xFE0F),    # Variation Selectors
+    (0x1F000, 0x1FFFF),  # All supplementary symbols
+]
+
+
+def font_codepoints(font_path: str) -> np.ndarray:
+    """Sorted int32 array of the BMP codepoints >= 0x20 that the font maps.
+
+    Unions every cmap subtable first, so codepoints covered by several subtables are filtered once.
+    """
+    tt = TTFont(font_path)
+    cps = set()
+    for table in tt['cmap'].tables:
+        if hasattr(table, 'cmap'):
+            cps.update(table.cmap.keys())
+    tt.close()
+    cps = np.fromiter(cps, dtype=np.int32, count=len(cps))
+    # Skip control chars and supplementary planes (mostly emoji)
+    return np.sort(cps[(cps >= 0x20) & (cps <= 0xFFFF)])
+
+
+def baseline_y_offset(font: ImageFont.FreeTypeFont) -> int:
+    """Draw y that puts the baseline at ~75% down the cell (constant per font)."""
+    ascent, descent = font.getmetrics()
+    baseline_y = int(CELL_H * 0.75)
+    return baseline_y - ascent
+
+
+def _draw_glyph(draw: ImageDraw.ImageDraw, char: str, font: ImageFont.FreeTypeFont, y: int):
+    # Center horizontally in cell
+    bbox = draw.textbbox((0, 0), char, font=font)
+    char_w = bbox[2] - bbox[0]
+    x = (CELL_W - char_w) // 2 - bbox[0]
+    draw.text((x, y), char, font=font, fill=255)
+
+
+def render_glyph(char: str, font: ImageFont.FreeTypeFont, y: int) -> np.ndarray:
+    """Render char to an 8×16 uint8 cell, horizontally centered with natural baseline positioning.
+
+    y is the font's baseline_y_offset, computed once by the caller.
+    """
+    img = Image.new('L', (CELL_W, CELL_H), 0)
+    _draw_glyph(ImageDraw.Draw(img), char, font, y)
+    # Read raw pixel bytes directly instead of going through np.array(img)
+    return np.frombuffer(img.tobytes(), dtype=np.uint8).reshape(CELL_H, CELL_W)
+
+
+def _render_glyphs(chars: list[str], font: ImageFont.FreeTypeFont) -> np.ndarray:
+    """Render chars to a (k, 16, 8) uint8 array."""
+    y = baseline_y_offset(font)
+    # One canvas for the whole chunk: clear, draw, copy bytes out
+    canvas = Image.new('L', (CELL_W, CELL_H), 0)
+    draw = ImageDraw.Draw(canvas)
+    glyphs = np.empty((len(chars), CELL_H, CELL_W), dtype=np.uint8)
+    for i, char in enumerate(chars):
+        draw.rectangle((0, 0, CELL_W, CELL_H), fill=0)
+        _draw_glyph(draw, char, font, y)
+        glyphs[i] = np.frombuffer(canvas.tobytes(), dtype=np.uint8).reshape(CELL_H, CELL_W)
+    return glyphs
+
+
+def _render_chunk(font_args: tuple, chars: list[str]) -> np.ndarray:
+    """Worker-process entry: reopen the font with the caller's truetype() arguments and render."""
+    return _render_glyphs(chars, ImageFont.truetype(*font_args))
+
+
+def render_chars(chars: list[str], font: ImageFont.FreeTypeFont, workers: int | None = None) -> np.ndarray:
+    """Render chars to a (N, 16, 8) float32 array in [0, 1], split across processes for large N.
+
+    FreeType faces aren't picklable, so each worker reopens the font from its path with the
+    same size, index, encoding and layout engine. Workers send back uint8 tiles (a quarter of
+    the float32 IPC volume); scaling happens once here.
+    """
+    # Process startup only pays off with at least 1024 chars per worker
+    workers = min(workers or os.cpu_count() or 1, len(chars) // 1024)
+    if workers <= 1:
+        glyphs = _render_glyphs(chars, font)
+    else:
+        font_args = (font.path, font.size, font.index, font.encoding, font.layout_engine)
+        size = -(-len(chars) // workers)
+        chunks = [chars[i:i + size] for i in range(0, len(chars), size)]
+        glyphs = np.empty((len(chars), CELL_H, CELL_W), dtype=np.uint8)
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            parts = ex.map(partial(_render_chunk, font_args), chunks)
+            for start, part in zip(range(0, len(chars), size), parts):
+                glyphs[start:start + len(part)] = part
+    return np.divide(glyphs, 255.0, dtype=np.float32)
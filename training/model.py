@@ -1,5 +1,6 @@
 """CNN Encoder for 8×16 character images."""
 
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -11,15 +12,26 @@ CELL_W, CELL_H = 8, 16
 class CharEncoder(nn.Module):
     """CNN: (B, 1, 16, 8) -> (B, embedding_dim) normalized embeddings."""
 
-    def __init__(self, embedding_dim: int = 64):
+    def __init__(self, embedding_dim: int = 64, downsample: str = 'pool'):
+        """downsample: 'pool' (Conv→BN→ReLU→MaxPool, the original layout) or 'stride'
+        (stride-2 convs, no pooling pass). Layouts have different state_dict keys."""
         super().__init__()
         # 8×16 -> 4×8 -> 2×4 -> 1×2
-        self.conv = nn.Sequential(
-            nn.Conv2d(1, 32, 3, padding=1), nn.BatchNorm2d(32), nn.ReLU(), nn.MaxPool2d(2),
-            nn.Conv2d(32, 64, 3, padding=1), nn.BatchNorm2d(64), nn.ReLU(), nn.MaxPool2d(2),
-            nn.Conv2d(64, 128, 3, padding=1), nn.BatchNorm2d(128), nn.ReLU(), nn.MaxPool2d(2),
-        )
-        # After pooling: 1×2 × 128 = 256
+        if downsample == 'pool':
+            self.conv = nn.Sequential(
+                nn.Conv2d(1, 32, 3, padding=1), nn.BatchNorm2d(32), nn.ReLU(), nn.MaxPool2d(2),
+                nn.Conv2d(32, 64, 3, padding=1), nn.BatchNorm2d(64), nn.ReLU(), nn.MaxPool2d(2),
+                nn.Conv2d(64, 128, 3, padding=1), nn.BatchNorm2d(128), nn.ReLU(), nn.MaxPool2d(2),
+            )
+        elif downsample == 'stride':
+            self.conv = nn.Sequential(
+                nn.Conv2d(1, 32, 3, stride=2, padding=1), nn.BatchNorm2d(32), nn.ReLU(),
+                nn.Conv2d(32, 64, 3, stride=2, padding=1), nn.BatchNorm2d(64), nn.ReLU(),
+                nn.Conv2d(64, 128, 3, stride=2, padding=1), nn.BatchNorm2d(128), nn.ReLU(),
+            )
+        else:
+            raise ValueError(f"Unknown downsample mode: {downsample!r}")
+        # After downsampling: 1×2 × 128 = 256
         self.fc = nn.Sequential(
             nn.Flatten(),
             nn.Linear(128 * (CELL_H // 8) * (CELL_W // 8), 128), nn.ReLU(), nn.Dropout(0.2),
@@ -29,15 +41,51 @@ class CharEncoder(nn.Module):
     def forward(self, x):
         return F.normalize(self.fc(self.conv(x)), p=2, dim=1)
 
+    def fuse(self) -> 'CharEncoder':
+        """Fold each Conv→BN→ReLU into a single conv for inference/export. Switches to eval mode.
+
+        Changes state_dict keys, so call after loading weights and don't save the result.
+        """
+        self.eval()
+        groups = [[str(i), str(i + 1), str(i + 2)] for i, m in enumerate(self.conv) if isinstance(m, nn.Conv2d)]
+        torch.ao.quantization.fuse_modules(self.conv, groups, inplace=True)
+        return self
+
 
 def contrastive_loss(anchor, positive, temperature=0.1):
     """NT-Xent contrastive loss."""
     B = anchor.size(0)
     emb = torch.cat([anchor, positive], dim=0)
-    sim = emb @ emb.t() / temperature
-    labels = torch.cat([torch.arange(B) + B, torch.arange(B)]).to(anchor.device)
-    mask = torch.eye(2 * B, dtype=torch.bool, device=anchor.device)
-    return F.cross_entropy(sim.masked_fill(mask, float('-inf')), labels)
+    sim = torch.mm(emb, emb.t()).div_(temperature)
+    sim.fill_diagonal_(float('-inf'))  # Exclude self-similarity without allocating a mask
+    labels = torch.cat([torch.arange(B, 2 * B, device=anchor.device), torch.arange(B, device=anchor.device)])
+    return F.cross_entropy(sim, labels)
+
+
+def embed(encoder: CharEncoder, imgs, batch_size: int = 1024, compile: bool = False):
+    """Embed a (N, 1, 16, 8) float32 array in chunks under inference_mode -> (N, dim) unit rows.
+
+    compile=True wraps the encoder with torch.compile and zero-pads the last chunk so every
+    call hits the same compiled graph. Compilation costs tens of seconds, so it only pays
+    off on large sweeps.
+    """
+    encoder.eval()
+    compile = compile and hasattr(torch, 'compile')  # PyTorch >= 2.0
+    if compile:
+        encoder = torch.compile(encoder, mode='reduce-overhead', fullgraph=True)
+    x = torch.from_numpy(imgs)
+    n = x.size(0)
+    if compile and n % batch_size:
+        x = torch.cat([x, x.new_zeros(batch_size - n % batch_size, *x.shape[1:])])
+    with torch.inference_mode():
+        emb = torch.cat([encoder(b) for b in x.split(batch_size)])[:n].numpy()
+    return l2_normalize(emb)
+
+
+def l2_normalize(emb: np.ndarray) -> np.ndarray:
+    """Normalize rows in place so consumers can treat dot products as cosine similarity."""
+    emb /= np.linalg.norm(emb, axis=1, keepdims=True).clip(min=1e-12)
+    return emb
 
 
 if __name__ == '__main__':
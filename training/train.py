@@ -6,10 +6,9 @@ from pathlib import Path
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from dataset import CharacterDataset
+from dataset import CharacterDataset, make_loader
 from model import CharEncoder, contrastive_loss
 
 
@@ -18,11 +17,12 @@ def train(args):
     print(f"Device: {device}")
 
     dataset = CharacterDataset(args.font, args.charset, args.samples_per_char)
-    loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=0)
+    loader = make_loader(dataset, args.batch_size)
     num_classes = len(dataset.chars)
     print(f"Dataset: {len(dataset)} samples, {num_classes} chars")
 
-    encoder = CharEncoder(args.embedding_dim).to(device)
+    # NHWC layout picks the faster conv kernels (MKLDNN on CPU, tensor cores on GPU)
+    encoder = CharEncoder(args.embedding_dim, args.downsample).to(device, memory_format=torch.channels_last)
     
     # Load pretrained encoder weights if provided
     if args.from_checkpoint:
@@ -30,6 +30,13 @@ def train(args):
         ckpt = torch.load(args.from_checkpoint, map_location=device, weights_only=False)
         encoder.load_state_dict(ckpt['encoder'])
     
+    # Compiled view for the training step; encoder itself is kept for eval and state_dict.
+    # Default mode rather than 'reduce-overhead': CUDA graphs would overwrite emb_a's
+    # buffers when the encoder runs again for emb_p before backward.
+    train_encoder = encoder
+    if args.compile and hasattr(torch, 'compile'):
+        train_encoder = torch.compile(encoder, fullgraph=True)
+    
     classifier = nn.Linear(args.embedding_dim, num_classes).to(device)
     params = list(encoder.parameters()) + list(classifier.parameters())
     print(f"Params: {sum(p.numel() for p in params):,}")
@@ -37,6 +44,9 @@ def train(args):
     optimizer = optim.AdamW(params, lr=args.lr)
     scheduler = optim.lr_scheduler.OneCycleLR(optimizer, max_lr=args.lr, epochs=args.epochs, steps_per_epoch=len(loader))
     ce = nn.CrossEntropyLoss()
+    # Mixed precision on CUDA; disabled (plain fp32) on CPU
+    use_amp = device.type == 'cuda'
+    scaler = torch.amp.GradScaler('cuda', enabled=use_amp)
 
     output = Path(args.output)
     output.mkdir(exist_ok=True)
@@ -47,37 +57,42 @@ def train(args):
         classifier.train()
 
         for anchor, positive, labels in tqdm(loader, desc=f"Epoch {epoch+1}", leave=False):
-            anchor, positive, labels = anchor.to(device), positive.to(device), labels.to(device)
-            emb_a, emb_p = encoder(anchor), encoder(positive)
-
-            # Contrastive + classification
-            loss = contrastive_loss(emb_a, emb_p)
-            loss += (ce(classifier(emb_a), labels) + ce(classifier(emb_p), labels)) / 2
-
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            # Loader batches are pinned on CUDA, so these copies overlap with compute
+            anchor = anchor.to(device, memory_format=torch.channels_last, non_blocking=True)
+            positive = positive.to(device, memory_format=torch.channels_last, non_blocking=True)
+            labels = labels.to(device, non_blocking=True)
+            optimizer.zero_grad(set_to_none=True)
+            with torch.autocast(device.type, dtype=torch.float16, enabled=use_amp):
+                emb_a, emb_p = train_encoder(anchor), train_encoder(positive)
+
+                # Contrastive + classification
+                loss = contrastive_loss(emb_a, emb_p)
+                loss += (ce(classifier(emb_a), labels) + ce(classifier(emb_p), labels)) / 2
+
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
             scheduler.step()
 
         # Eval: nearest neighbor accuracy
         encoder.eval()
-        with torch.no_grad():
+        with torch.inference_mode():
             canonical = torch.stack([dataset.render_canonical(i) for i in range(num_classes)]).to(device)
             canonical_emb = encoder(canonical)
 
-            correct = 0
-            for i in range(num_classes):
-                for _ in range(3):  # 3 augmented tests per char
-                    test = dataset._render(dataset.chars[i], augment=True).unsqueeze(0).to(device)
-                    pred = (encoder(test) @ canonical_emb.t()).argmax().item()
-                    correct += pred == i
-            acc = correct / (num_classes * 3)
+            # 3 augmented tests per char, encoded in one batch
+            tests = torch.stack([dataset._cell(dataset.canonical[i], augment=True)
+                                 for i in range(num_classes) for _ in range(3)]).to(device, non_blocking=True)
+            preds = (encoder(tests) @ canonical_emb.t()).argmax(dim=1)
+            targets = torch.arange(num_classes, device=device).repeat_interleave(3)
+            acc = (preds == targets).float().mean().item()
 
         print(f"Epoch {epoch+1}: acc={acc:.1%}")
 
         if acc > best_acc:
             best_acc = acc
-            torch.save({'encoder': encoder.state_dict(), 'embedding_dim': args.embedding_dim, 'chars': dataset.chars}, output / 'best.pt')
+            torch.save({'encoder': encoder.state_dict(), 'embedding_dim': args.embedding_dim,
+                        'downsample': args.downsample, 'chars': dataset.chars}, output / 'best.pt')
 
     print(f"Best: {best_acc:.1%}")
 
@@ -90,7 +105,10 @@ if __name__ == '__main__':
     p.add_argument('--batch-size', type=int, default=256)
     p.add_argument('--lr', type=float, default=5e-3)
     p.add_argument('--embedding-dim', type=int, default=64)
+    p.add_argument('--downsample', choices=['pool', 'stride'], default='pool',
+                   help="'stride' replaces MaxPool with stride-2 convs (not compatible with pool checkpoints)")
     p.add_argument('--samples-per-char', type=int, default=100)
     p.add_argument('--output', default='checkpoints')
     p.add_argument('--from-checkpoint', help='Load pretrained encoder weights')
+    p.add_argument('--compile', action='store_true', help='torch.compile the encoder (pays off for long runs)')
     train(p.parse_args())